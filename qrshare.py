@@ -40,7 +40,7 @@ import urllib.request
 import mimetypes
 import re
 
-from threading import Thread
+from threading import Thread, Lock
 
 import zeroconf
 
@@ -59,7 +59,10 @@ import cairosvg
 
 import asyncio
 
-from time import sleep
+import json
+import queue
+
+from time import sleep, time, strftime, localtime
 
 # -------- Functions
 
@@ -178,6 +181,174 @@ class ZeroconfService:
         self.zeroconf.close()
 
 
+# -------- Access log
+
+
+class AccessLog:
+
+    def __init__(self, file_path, batch_size=64, flush_interval=1.0,
+                 max_bytes=1024 * 1024, backup_count=3, queue_size=4096):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.__dropped = 0
+        self.__dropped_lock = Lock()
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__stream = None
+        self.__lock_file = None
+        self.__thread = None
+
+    def start(self):
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        # None tells the writer to flush what is left and exit
+        try:
+            self.__queue.put(None, timeout=self.flush_interval)
+        except queue.Full:
+            pass
+        self.__thread.join(timeout=self.flush_interval * 2)
+        self.__thread = None
+
+    def log_request(self, handler):
+        # Called by tornado from the IO loop, must never block
+        request = handler.request
+        record = {'time': time(),
+                  'client': request.remote_ip,
+                  'method': request.method,
+                  'route': getattr(handler, 'route', None),
+                  'path': request.path,
+                  'status': handler.get_status(),
+                  'bytes': getattr(handler, 'bytes_written', 0),
+                  'duration': round(request.request_time(), 6),
+                  'range': request.headers.get('Range')}
+        note = getattr(handler, 'note', None)
+        if note is not None:
+            record['note'] = note
+        try:
+            self.__queue.put_nowait(record)
+        except queue.Full:
+            self.__count_dropped(1)
+
+    def format_record(self, record):
+        return json.dumps(record, sort_keys=True)
+
+    def __count_dropped(self, count):
+        with self.__dropped_lock:
+            self.__dropped += count
+
+    def __take_dropped(self):
+        with self.__dropped_lock:
+            count = self.__dropped
+            self.__dropped = 0
+        return count
+
+    def __next_batch(self):
+        # Waits for a first record, then collects more until the batch is
+        # full or flush_interval has passed since that first record
+        batch = []
+        try:
+            batch.append(self.__queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.__queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def __run(self):
+        running = True
+        while running:
+            batch = self.__next_batch()
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+            dropped = self.__take_dropped()
+            if dropped:
+                batch.insert(0, {'time': time(), 'dropped': dropped})
+            if batch:
+                written = self.__write(batch)
+                self.__count_dropped(sum(record.get('dropped', 1) for record in batch[written:]))
+        if self.__stream is not None:
+            self.__stream.close()
+            self.__stream = None
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+            self.__lock_file = None
+
+    def __write(self, batch):
+        # Returns the number of records written before an error occurred
+        written = 0
+        try:
+            self.__open()
+            # Other qrshare processes share the file, the lock keeps their
+            # size checks, rotations and writes from interleaving
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX)
+            try:
+                for record in batch:
+                    line = (self.format_record(record) + "\n").encode('utf-8')
+                    self.__open()
+                    size = os.fstat(self.__stream.fileno()).st_size
+                    if self.max_bytes > 0 and size > 0 and size + len(line) > self.max_bytes:
+                        self.__rotate()
+                        self.__open()
+                    self.__stream.write(line)
+                    written += 1
+            finally:
+                fcntl.flock(self.__lock_file, fcntl.LOCK_UN)
+        except (IOError, OSError):
+            if self.__stream is not None:
+                self.__stream.close()
+                self.__stream = None
+        return written
+
+    def __open(self):
+        # Other qrshare processes append to the same file and may have
+        # rotated it, so reopen when the path points to a different file
+        if self.__stream is not None:
+            try:
+                stat = os.stat(self.file_path)
+                current = os.fstat(self.__stream.fileno())
+                if stat.st_dev == current.st_dev and stat.st_ino == current.st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.__stream.close()
+            self.__stream = None
+        directory = os.path.dirname(self.file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.__lock_file is None:
+            self.__lock_file = open(self.file_path + '.lock', mode='a')
+        # Unbuffered, so every line is a single append and the file size
+        # seen by all processes is up to date
+        self.__stream = open(self.file_path, mode='ab', buffering=0)
+
+    def __rotate(self):
+        self.__stream.close()
+        self.__stream = None
+        if self.backup_count <= 0:
+            os.remove(self.file_path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '{0}.{1}'.format(self.file_path, index)
+            if os.path.exists(source):
+                os.replace(source, '{0}.{1}'.format(self.file_path, index + 1))
+        os.replace(self.file_path, self.file_path + '.1')
+
+
 # -------- Web server
 
 
@@ -215,7 +386,8 @@ class WebServer:
         self.__zeroconf_service.publish()
         # Executing server
         asyncio.set_event_loop(asyncio.new_event_loop())
-        self.__application_service = tornado.web.Application([(r'.*', DefaultHandler)])  
+        self.__application_service = tornado.web.Application([(r'.*', DefaultHandler)],
+                                                             log_function=access_log.log_request)
         self.__server = tornado.httpserver.HTTPServer(self.__application_service)
         self.loop = tornado.ioloop.IOLoop.instance()
         self.__server.listen(self.__port)
@@ -229,8 +401,20 @@ class WebServer:
 
 class BasicRequestHandler(tornado.web.RequestHandler):
 
+    def initialize(self):
+        self.route = None
+        self.note = None
+        self.bytes_written = 0
+
+    def flush(self, include_footers=False):
+        # Count what actually leaves the buffer, tornado discards the body
+        # of 304 responses in finish() before flushing
+        self.bytes_written += sum(len(part) for part in self._write_buffer)
+        return super().flush(include_footers)
+
     def log(self, message):
-        print(message)
+        # Attached to the access log record when the request finishes
+        self.note = message
 
     def send_file_not_found_error(self):
         self.log('Error: 404 File Not Found: %s' % self.request.path)
@@ -260,18 +444,21 @@ class DefaultHandler(BasicRequestHandler):
         file_pattern = re.compile("^\/%s\/([0-9]+)$" % file_list.get_file_dir())
         # Delivering content
         if (path == "/") or (path == "/index.html"):
+            self.route = "index"
             data = file_list.get_html
             self.set_header('Content-Type', 'text/html')
             self.set_header('Content-Length', '{0}'.format(len(data)))
             self.write(data)
             self.finish()
         elif (path == "/favicon.ico"):
+            self.route = "favicon"
             favicon = base64.b64decode( "AAABAAEAICAQAAEABADoAgAAFgAAACgAAAAgAAAAQAAAAAEABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAQAAFRcVACUoJgA9Pz0ATlFPAGZpZwBydXMAe358AJGUkgClqKYAtbi1AMjMyQDW2dcA5OjlAPz//QAAAAAA7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7d3d3N7O3d3u3d7t7u7u7rFEREN+DZNH3mOe4N7u7u627u7sfg2a7QALt+AN7u7utuMzu37nvsbu7rfuTO7u7rbgAKxubKed7py37k3u7u624ACrfr7YjplL3Om+7u7utumZzH7u62oJSbzgve7u7rXd3dp+3dtnfpRIwG3u7u6xERERfgEZ7u7pnRHu7u7u7u7u7u4N647u6p7u7u7u7sVV2rxVDarFZVM1fn3u7u6wANlZzAzqnMC4jMgt7u7u2gDchqoJzbqb7LqbPe7u7toA3amZmd7Znsupnkzu7u6wB8m+3e3d7u1Qnt2N7u7usA5s6wDnCu7gAJ0A7u7u7u7u7u7uAAAF7u7u7u7u7u7Hd3d2ngyJted2d3d97u7utMvLyX4N2oXhrMvLPe7u7rbqutt+De2F4dyqvk3u7u624ACsfpvduuHZAD5N7u7utuAAq37VvJ3hyQA+TO7u7rbgAKx+AL7F4dkAPk3u7u627u7rfgC7juHe7u5N7u7us2d3dX7WuzjhV3d3LO7u7tu7u7vO7N2867u7u77u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u7u4AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA==")
             self.set_header('Content-Type', 'image/x-icon')
             self.set_header('Content-Length', '{0}'.format(len(favicon)))
             self.write(favicon)
             
         elif icon_pattern.match(path):
+            self.route = "icon"
             try:
                 head, index_string = os.path.split(path)
                 index = int(index_string)
@@ -293,6 +480,7 @@ class DefaultHandler(BasicRequestHandler):
             except IOError:
                 self.send_file_not_found_error()
         elif file_pattern.match(path):
+            self.route = "file"
             try:
                 head, index_string = os.path.split(path)
                 index = int(index_string)
@@ -578,11 +766,14 @@ class Application(object):
 def main():
     for file_path in sys.argv[1:]:
         file_list.add(file_path)
+    access_log.start()
     app = Application()
     Gtk.main()
     sleep(3)
+    access_log.stop()
 
 
 if __name__ == "__main__":
     file_list = FileList()
+    access_log = AccessLog(os.path.join(GLib.get_user_cache_dir(), 'qrshare', 'access.log'))
     main()